@@ -1,16 +1,18 @@
+import importlib
 import os
 import re
 import subprocess
 import sys
 import json
+import threading
 from urllib.parse import urlparse
-import uuid
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import warnings
 
 import numpy as np
 from typing import Any, List, Tuple
-from glob import glob
 
 try:
     import stashapi.log as log
@@ -24,10 +26,14 @@ except ModuleNotFoundError:
 plugincodename = "stash2clip"
 pluginhumanname = "Stash2Clip"
 
-# Configuration/settings file... because not everything can be easily built/controlled via the UI plugin settings
-# If you don't need this level of configuration, just define the default_settings here directly in code,
-#    and you can remove the _defaults.py file and the below code
-if not os.path.exists("config.py"):
+
+def ensure_config():
+    """
+    The ensure_config function creates the config.py file from the plugin defaults on first use.
+
+    :return: Nothing
+    :doc-author: Trelent
+    """
     with open(plugincodename + "_defaults.py", "r") as default:
         config_lines = default.readlines()
     with open("config.py", "w") as firstrun:
@@ -36,7 +42,18 @@ if not os.path.exists("config.py"):
             if not line.startswith("##"):
                 firstrun.write(f"#{line}")
 
-import config
+
+# Configuration/settings file... because not everything can be easily built/controlled via the UI plugin settings
+# If you don't need this level of configuration, just define the default_settings here directly in code,
+#    and you can remove the _defaults.py file and the below code
+try:
+    import config
+except ModuleNotFoundError as ex:
+    if ex.name != "config":
+        raise
+    ensure_config()
+    importlib.invalidate_caches()
+    import config
 
 default_settings = config.default_settings
 
@@ -48,9 +65,84 @@ BATCH_QTY = default_settings["batch_quantity"]
 OUTPUT_DIR = default_settings["output_dir"]
 DEFAULT_DURATION = default_settings["default_duration"]
 CONVERTED_TAG_ID = default_settings["converted_tag_id"]
+LOG_LEVEL = str(default_settings.get("log_level", "trace")).lower()
+
+# STASH_TMP with a trailing separator, so file names can be appended directly
+_TMPDIR = STASH_TMP if STASH_TMP.endswith(os.path.sep) else (STASH_TMP + os.path.sep)
+
+# Extension of a file path, without the dot
+_EXT_RE = re.compile(r"\.([^.]+)$")
+
+# Video file extensions that can be converted
+VALID_EXTS = frozenset(
+    {
+        ".m4v",
+        ".mp4",
+        ".mov",
+        ".wmv",
+        ".avi",
+        ".mpg",
+        ".mpeg",
+        ".rmvb",
+        ".rm",
+        ".flv",
+        ".asf",
+        ".mkv",
+        ".webm",
+        ".3gp",
+    }
+)
+
+# ffmpeg invocation shared by all commands: no stdin polling, banner or progress output, overwrite outputs
+FFMPEG_CMD = ("ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y")
+
+# Prefix of the files downloaded by save_to_local
+TEMP_PREFIX = "downloaded_"
+
+# Longest command line passed to ffmpeg, kept under the Windows limit of 32767 characters
+MAX_CMD_LENGTH = 32000
+
+# Downloads are streamed to disk in chunks of this many bytes
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# Seconds to wait for the server to connect or send more data
+DOWNLOAD_TIMEOUT = 30
 
 warnings.filterwarnings("ignore")
 
+# stash_log levels, mapped to their stashapi log level and log function
+_LOG_LEVELS = {
+    "trace": (log.StashLogLevel.TRACE, log.trace),
+    "debug": (log.StashLogLevel.DEBUG, log.debug),
+    "info": (log.StashLogLevel.INFO, log.info),
+    "warn": (log.StashLogLevel.WARNING, log.warning),
+    "error": (log.StashLogLevel.ERROR, log.error),
+    "result": (log.StashLogLevel.INFO, log.result),
+}
+# Messages below this level are dropped by stash_log
+if LOG_LEVEL not in _LOG_LEVELS or LOG_LEVEL == "result":
+    log.warning(f"{PLUGIN_NAME}unknown log_level '{LOG_LEVEL}', falling back to 'trace'")
+    LOG_LEVEL = "trace"
+_LOG_THRESHOLD = _LOG_LEVELS[LOG_LEVEL][0]
+
+# stash_log swaps the global log.LEVEL and is called from the clip extraction worker threads
+_log_lock = threading.Lock()
+
+# Shared HTTP session, so downloads reuse pooled keep-alive connections and retry transient errors
+_session = requests.Session()
+_http_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+)
+_session.mount("http://", _http_adapter)
+_session.mount("https://", _http_adapter)
+
+# get_stash_video results keyed by scene id (scene dicts are unhashable, so no lru_cache)
+_stash_video_cache = {}
+
+# Files downloaded by save_to_local that haven't been removed yet
+_temp_files = set()
+
 
 def stash_log(*args, **kwargs):
     """
@@ -61,6 +153,20 @@ def stash_log(*args, **kwargs):
     :return: The message
     :doc-author: Trelent
     """
+    lvl = kwargs["lvl"] if "lvl" in kwargs else "info"
+    if lvl == "progress":
+        try:
+            progress = min(max(0, float(args[0])), 1)
+            with _log_lock:
+                log.progress(str(progress))
+        except:
+            pass
+        return
+
+    # bail out before serializing anything if the message would not be emitted (the plugin result always is)
+    if lvl not in _LOG_LEVELS or (lvl != "result" and _LOG_LEVELS[lvl][0] < _LOG_THRESHOLD):
+        return
+
     messages = []
     for input in args:
         if not isinstance(input, str):
@@ -73,33 +179,13 @@ def stash_log(*args, **kwargs):
     if len(messages) == 0:
         return
 
-    lvl = kwargs["lvl"] if "lvl" in kwargs else "info"
     message = " ".join(messages)
+    level, emit = _LOG_LEVELS[lvl]
 
-    if lvl == "trace":
-        log.LEVEL = log.StashLogLevel.TRACE
-        log.trace(message)
-    elif lvl == "debug":
-        log.LEVEL = log.StashLogLevel.DEBUG
-        log.debug(message)
-    elif lvl == "info":
+    with _log_lock:
+        log.LEVEL = level
+        emit(message)
         log.LEVEL = log.StashLogLevel.INFO
-        log.info(message)
-    elif lvl == "warn":
-        log.LEVEL = log.StashLogLevel.WARNING
-        log.warning(message)
-    elif lvl == "error":
-        log.LEVEL = log.StashLogLevel.ERROR
-        log.error(message)
-    elif lvl == "result":
-        log.result(message)
-    elif lvl == "progress":
-        try:
-            progress = min(max(0, float(args[0])), 1)
-            log.progress(str(progress))
-        except:
-            pass
-    log.LEVEL = log.StashLogLevel.INFO
 
 
 def default_json(t):
@@ -162,45 +248,69 @@ def save_to_local(url, ext="jpg"):
     :return: The filename of the downloaded file
     :doc-author: Trelent
     """
-    directory = STASH_TMP if STASH_TMP.endswith(os.path.sep) else (STASH_TMP + os.path.sep)
     # Generate a unique filename
-    filename = f"{directory}downloaded_{uuid.uuid4()}.{ext}"
+    filename = os.path.join(_TMPDIR, f"{TEMP_PREFIX}{os.urandom(8).hex()}.{ext}")
 
     try:
-        # Send an HTTP GET request to the URL
-        response = requests.get(url)
-
-        # Check if the request was successful (status code 200)
-        if response.status_code == 200:
-            # Open the local file in binary write mode and write the content from the URL to it
-            with open(filename, "wb") as local_file:
-                local_file.write(response.content)
-            stash_log(f"Downloaded and saved file to {filename}", lvl="debug")
-        else:
-            stash_log(f"Failed to download file: {response.status_code}", lvl="error")
-            return None
-    except requests.exceptions.RequestException as e:
-        stash_log(f"Failed to download file: {e}", lvl="error")
+        # Send an HTTP GET request to the URL, without buffering the whole body in memory
+        with _session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            # Check if the request was successful (status code 200)
+            if response.status_code == 200:
+                # Open the local file in binary write mode and stream the content from the URL to it
+                with open(filename, "wb") as local_file:
+                    _temp_files.add(filename)
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        local_file.write(chunk)
+                stash_log(f"Downloaded and saved file to {filename}", lvl="debug")
+            else:
+                stash_log(f"Failed to download file {url}: {response.status_code}", lvl="error")
+                return None
+    except (requests.exceptions.RequestException, OSError) as e:
+        stash_log(f"Failed to download file {url}: {e}", lvl="error")
+        release_temp_file(filename)
         return None
 
     return filename
 
 
+def release_temp_file(path):
+    """
+    The release_temp_file function removes a file downloaded by save_to_local once it is no longer needed.
+    Paths that weren't downloaded by save_to_local are left alone.
+
+    :param path: Specify the path of the downloaded file
+    :return: Nothing
+    :doc-author: Trelent
+    """
+    if path not in _temp_files:
+        return
+    _temp_files.discard(path)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        stash_log(f"could not remove {path}: {e}", lvl="error")
+
+
 def clear_tempdir():
     """
-    The clear_tempdir function is used to clear the temporary directory of all files.
+    The clear_tempdir function is used to clear the temporary directory of sprites and downloaded files.
     This function is called when a user requests that the temp directory be cleared, or when an error occurs in which case it will attempt to clear the temp dir before exiting.
 
     :return: A boolean value
     :doc-author: Trelent
     """
-    tmpdir = STASH_TMP if STASH_TMP.endswith(os.path.sep) else (STASH_TMP + os.path.sep)
-    for f in glob(f"{tmpdir}*.jpg"):
-        try:
-            os.remove(f)
-        except OSError as e:
-            stash_log(f"could not remove {f}", lvl="error")
-            continue
+    with os.scandir(_TMPDIR) as entries:
+        for entry in entries:
+            if not (entry.name.endswith(".jpg") or entry.name.startswith(TEMP_PREFIX)):
+                continue
+            try:
+                os.unlink(entry.path)
+            except OSError as e:
+                stash_log(f"could not remove {entry.path}: {e}", lvl="error")
+                continue
+    _temp_files.clear()
     stash_log("cleared temp directory.", lvl="debug")
 
 
@@ -224,7 +334,7 @@ def to_integer(iter=[]):
     :return: A list of integers
     :doc-author: Trelent
     """
-    return list(map(lambda x: int(x), iter))
+    return list(map(int, iter))
 
 
 def to_string(iter=[]):
@@ -235,7 +345,7 @@ def to_string(iter=[]):
     :return: A list of strings
     :doc-author: Trelent
     """
-    return list(map(lambda x: str(x), iter))
+    return list(map(str, iter))
 
 
 def the_id(iter=[]):
@@ -249,7 +359,7 @@ def the_id(iter=[]):
     :return: A list of the ids from a list of dictionaries
     :doc-author: Trelent
     """
-    return list(map(lambda x: x["id"] if isinstance(x, dict) and "id" in x else x, iter))
+    return [x["id"] if isinstance(x, dict) and "id" in x else x for x in iter]
 
 
 def omit_dict(obj: dict, keys: any):
@@ -269,18 +379,26 @@ def omit_dict(obj: dict, keys: any):
             if isinstance(keys, str):
                 return {k: v for k, v in _obj.items() if k != keys}
             elif isinstance(keys, list) or isinstance(keys, tuple):
+                # collect everything to omit first, so the dict is only rebuilt once
+                omit = set()
+                nested = []
                 for key in keys:
                     if isinstance(key, dict) and len(key) == 1:
-                        _key = list(key.keys())[0]
-                        if _key in _obj:
-                            if isinstance(key[_key], dict):
-                                _obj[_key] = omit_dict(_obj[_key], key[_key])
-                            elif isinstance(key[_key], str):
-                                _obj = {k: v for k, v in _obj.items() if k != key[_key]}
+                        _key, _value = next(iter(key.items()))
+                        # only keys that haven't been omitted by an earlier entry count, as in a sequential pass
+                        if _key in _obj and _key not in omit:
+                            if isinstance(_value, dict):
+                                nested.append((_key, _value))
+                            elif isinstance(_value, str):
+                                omit.add(_value)
                     elif isinstance(key, str):
-                        _obj = {k: v for k, v in _obj.items() if k != key}
+                        omit.add(key)
+                _obj = {k: v for k, v in _obj.items() if k not in omit}
+                for _key, _value in nested:
+                    if _key in _obj:
+                        _obj[_key] = omit_dict(_obj[_key], _value)
             elif isinstance(keys, dict) and len(keys) == 1:
-                _key = list(keys.keys())[0]
+                _key = next(iter(keys))
                 if _key in _obj:
                     if isinstance(keys[_key], dict):
                         _obj[_key] = omit_dict(_obj[_key], keys[_key])
@@ -300,7 +418,7 @@ def prepare_stash_list(iter=[]):
     :return: A list of strings
     :doc-author: Trelent
     """
-    return list(set(to_string(iter)))
+    return list({str(x) for x in iter})
 
 
 def create_tag(stash: StashInterface, tagName):
@@ -333,52 +451,64 @@ def find_tag(stash: StashInterface, tagName, create=False):
 def get_stash_video(vid_data):
     """
     The get_stash_video function takes in a video data object and returns the raw video file.
+    Results are cached by scene id, so the file lookup (or download) only happens once per scene.
+
+    :param vid_data: Get the video data from the stash
+    :return: A dictionary with the following keys:
+    :doc-author: Trelent
+    """
+    vid_id = vid_data["id"]
+    if vid_id not in _stash_video_cache:
+        _stash_video_cache[vid_id] = _resolve_stash_video(vid_data)
+    return _stash_video_cache[vid_id]
+
+
+def release_stash_video(vid_id):
+    """
+    The release_stash_video function drops the cached video of a scene once its clips are extracted,
+    and removes the video file if get_stash_video had to download it.
+
+    :param vid_id: Specify the id of the scene
+    :return: Nothing
+    :doc-author: Trelent
+    """
+    raw = _stash_video_cache.pop(vid_id, None)
+    if raw is not None:
+        release_temp_file(raw["path"])
+
+
+def _resolve_stash_video(vid_data):
+    """
+    The _resolve_stash_video function locates the video file of a scene, downloading it when it is not available locally.
 
     :param vid_data: Get the video data from the stash
     :return: A dictionary with the following keys:
     :doc-author: Trelent
     """
     props = ["id", "path", "format", "width", "height", "duration", "frame_rate"]
-    raw = None
     files = vid_data["files"]
 
-    for file in files:
-        test: str = file["path"]
-        if os.path.exists(test):
-            raw = {k: file[k] for k in props}
-            break
-
-    if raw is None:
+    file = next((file for file in files if os.path.exists(file["path"])), None)
+    if file is not None:
+        raw = {k: file[k] for k in props}
+    else:
         url = vid_data["paths"]["stream"]
         ext = "mp4"
-        ext_match = re.search(r"\.([^.]+)$", files[0]["path"])
+        ext_match = _EXT_RE.search(files[0]["path"])
         if ext_match:
             ext = ext_match.group(1)
-        raw = {k: file[k] for k in props}
+        # don't download a stream that couldn't be converted anyway
+        if f".{ext}".lower() not in VALID_EXTS:
+            return None
+        raw = {k: files[0][k] for k in props}
         raw["path"] = save_to_local(url, ext)
 
-    if raw is not None:
+    if raw["path"] is not None:
         raw["sprite"] = vid_data["paths"]["sprite"]
         raw["vtt"] = vid_data["paths"]["vtt"]
-        valid = (
-            ".m4v",
-            ".mp4",
-            ".mov",
-            ".wmv",
-            ".avi",
-            ".mpg",
-            ".mpeg",
-            ".rmvb",
-            ".rm",
-            ".flv",
-            ".asf",
-            ".mkv",
-            ".webm",
-            ".flv",
-            ".3gp",
-        )
-        if raw["path"].lower().endswith(valid):
+        if os.path.splitext(raw["path"])[1].lower() in VALID_EXTS:
             return raw
+        release_temp_file(raw["path"])
 
     return None
 
@@ -404,36 +534,193 @@ def seconds_to_timecode(seconds):
     :return: A string that represents the timecode
     :doc-author: Trelent
     """
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    seconds = seconds % 60
-    return f"{hours:02}:{minutes:02}:{seconds:06.3f}"
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{int(hours):02}:{int(minutes):02}:{seconds:06.3f}"
+
+
+def list_output_dir(output_dir: str) -> set:
+    """
+    The list_output_dir function creates the output directory if it doesn't exist already,
+    and returns the names of the files it contains.
+
+    :param output_dir: str: Specify the directory where the clips are saved
+    :return: A set of file names
+    :doc-author: Trelent
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    with os.scandir(output_dir) as entries:
+        return {entry.name for entry in entries}
+
+
+def clip_spec(marker: dict, duration: int):
+    """
+    The clip_spec function calculates the start timecode of the clip for a marker, and the name of its file.
+
+    :param marker: dict: Pass in the marker information
+    :param duration: int: Specify the length of the clip in seconds
+    :return: A tuple of the start time and output file name
+    :doc-author: Trelent
+    """
+    start_time = seconds_to_timecode(marker["seconds"])
+    output_file = "_".join(["Clip", marker["id"], "Scene", marker["scene"]["id"], start_time, f"{duration}s"]) + ".mp4"
+    return start_time, output_file
+
+
+def clips_exist(markers: list, duration: int, existing: set) -> bool:
+    """
+    The clips_exist function checks whether the clips of all the given markers are in the output directory.
+
+    :param markers: list: Pass in the markers of a scene
+    :param duration: int: Specify the length of the clips in seconds
+    :param existing: set: Pass in the file names in the output directory, as returned by list_output_dir
+    :return: True if every clip exists
+    :doc-author: Trelent
+    """
+    return all(clip_spec(marker, duration)[1] in existing for marker in markers)
+
+
+def clip_input_args(input_path: str, start_time: str, duration: int) -> list:
+    """
+    The clip_input_args function returns the ffmpeg input options that open input_path for a single clip.
+    The seek is done on the input, so the copied clip starts at the keyframe at or before start_time.
+
+    :param input_path: str: Specify the path to the video file
+    :param start_time: str: Specify the start timecode of the clip
+    :param duration: int: Specify the length of the clip in seconds
+    :return: A list of ffmpeg arguments
+    :doc-author: Trelent
+    """
+    return ["-ss", start_time, "-t", str(duration), "-i", input_path]
+
+
+def clip_output_args(input_index: int, output_path: str) -> list:
+    """
+    The clip_output_args function returns the ffmpeg output options that copy the first video and audio stream
+    of the input at input_index to output_path.
+
+    :param input_index: int: Specify the index of the clip's input in the ffmpeg command
+    :param output_path: str: Specify the path of the output file
+    :return: A list of ffmpeg arguments
+    :doc-author: Trelent
+    """
+    return [
+        "-map",
+        f"{input_index}:v:0?",
+        "-map",
+        f"{input_index}:a:0?",
+        "-c",
+        "copy",
+        "-avoid_negative_ts",
+        "make_zero",
+        output_path,
+    ]
 
 
-def extract_clip(input_path: str, marker: dict, duration: int, output_dir: str) -> str:
+def run_ffmpeg(cmd: list):
+    """
+    The run_ffmpeg function runs an ffmpeg command and collects what it printed on stderr.
+    With -loglevel error that is only the error messages, so it is small enough to keep in memory.
+
+    :param cmd: list: Specify the ffmpeg command to run
+    :return: A tuple of the return code and the stderr output
+    :doc-author: Trelent
+    """
+    process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    _, errors = process.communicate()
+    return process.returncode, errors.decode(errors="replace").strip()
+
+
+def extract_clip(input_path: str, marker: dict, duration: int, output_dir: str, existing: set) -> str:
     """
     The extract_clip function takes an input video file, a marker dict, and a duration in seconds.
-    It then creates the output directory if it doesn't exist already. It calculates the start time of
-    the clip by adding the marker's &quot;seconds&quot; value to its own start_time variable. Then it uses ffmpeg
-    to extract that clip from the input video and save it as an mp4 file in the output directory.
+    It calculates the start time of the clip by adding the marker's &quot;seconds&quot; value to its own
+    start_time variable. Then it uses ffmpeg to extract that clip from the input video and save it as
+    an mp4 file in the output directory, unless the clip is already listed in existing.
 
     :param input_path: str: Specify the path to the video file
     :param marker: dict: Pass in the marker information
     :param duration: int: Specify the length of the clip in seconds
     :param output_dir: str: Specify the directory where the output file will be saved
+    :param existing: set: Pass in the file names already in the output directory, as returned by list_output_dir
     :return: The path to the extracted clip
     :doc-author: Trelent
     """
-    os.makedirs(output_dir, exist_ok=True)
-    marker_start = marker["seconds"]
-    start_time = seconds_to_timecode(marker_start)
-    end_time = seconds_to_timecode(marker_start + duration)
-    output_file = "_".join(["Clip", marker["id"], "Scene", marker["scene"]["id"], start_time, f"{duration}s"]) + ".mp4"
+    start_time, output_file = clip_spec(marker, duration)
     output_path = os.path.join(output_dir, output_file)
-    if os.path.isfile(output_path):
+    if output_file in existing:
         stash_log(f"{output_file} already exists, skipping...")
     else:
-        cmd = ["ffmpeg", "-y", "-ss", start_time, "-to", end_time, "-i", input_path, "-c", "copy", output_path]
-        result = subprocess.run(cmd)
-        return output_path if result.returncode == 0 else None
+        cmd = [*FFMPEG_CMD, *clip_input_args(input_path, start_time, duration), *clip_output_args(0, output_path)]
+        returncode, errors = run_ffmpeg(cmd)
+        if returncode == 0:
+            existing.add(output_file)
+            return output_path
+        stash_log(f"ffmpeg failed to extract {output_file} from {input_path}:", errors, lvl="error")
+        remove_clips([output_path])
     return None
+
+
+def extract_clips(input_path: str, markers: list, duration: int, output_dir: str, existing: set):
+    """
+    The extract_clips function extracts the clips for all markers of a video with a single ffmpeg process.
+    Every clip that isn't already listed in existing gets its own input, seeked to the marker before it is opened,
+    and its own output copying the first video and audio stream of that input.
+
+    :param input_path: str: Specify the path to the video file
+    :param markers: list: Pass in the markers of the video
+    :param duration: int: Specify the length of the clips in seconds
+    :param output_dir: str: Specify the directory where the output files will be saved
+    :param existing: set: Pass in the file names already in the output directory, as returned by list_output_dir
+    :return: A list of clip paths in the order of the markers, or None if the command line would exceed MAX_CMD_LENGTH
+    :doc-author: Trelent
+    """
+    inputs = []
+    outputs = []
+    results = []
+    pending = []
+    for marker in markers:
+        start_time, output_file = clip_spec(marker, duration)
+        if output_file in existing:
+            stash_log(f"{output_file} already exists, skipping...")
+            results.append(None)
+            continue
+        output_path = os.path.join(output_dir, output_file)
+        inputs += clip_input_args(input_path, start_time, duration)
+        outputs += clip_output_args(len(pending), output_path)
+        pending.append((len(results), output_file))
+        results.append(output_path)
+
+    if len(pending) == 0:
+        return results
+    cmd = [*FFMPEG_CMD, *inputs, *outputs]
+    if sum(len(arg) + 1 for arg in cmd) > MAX_CMD_LENGTH:
+        return None
+
+    returncode, errors = run_ffmpeg(cmd)
+    if returncode == 0:
+        existing.update(output_file for _, output_file in pending)
+    else:
+        stash_log(f"ffmpeg failed to extract {len(pending)} clips from {input_path}:", errors, lvl="error")
+        remove_clips([results[index] for index, _ in pending])
+        for index, _ in pending:
+            results[index] = None
+    return results
+
+
+def remove_clips(paths: list):
+    """
+    The remove_clips function removes the clips a failed ffmpeg run may have left behind,
+    so they aren't taken for finished clips by list_output_dir on the next run.
+
+    :param paths: list: Specify the paths of the clips to remove
+    :return: Nothing
+    :doc-author: Trelent
+    """
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            stash_log(f"could not remove {path}: {e}", lvl="error")
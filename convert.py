@@ -1,8 +1,78 @@
+import os
+import queue
+import re
+import threading
 import traceback
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
 from urllib.parse import unquote
 from stashapi.stashapp import StashInterface
-from common import DEFAULT_DURATION, OUTPUT_DIR, extract_clip, stash_log, get_stash_video
+from common import CONVERTED_TAG_ID, DEFAULT_DURATION, OUTPUT_DIR, clips_exist, extract_clip, extract_clips, list_output_dir, release_stash_video, stash_log, get_stash_video
+
+# Scene fields needed to convert its markers, so the markers come embedded in the scene query
+SCENE_WITH_MARKERS_FRAGMENT = """
+fragment SceneWithMarkers on Scene {
+    id
+    files {
+        id
+        path
+        format
+        width
+        height
+        duration
+        frame_rate
+    }
+    paths {
+        stream
+        sprite
+        vtt
+    }
+    scene_markers {
+        id
+        seconds
+        scene {
+            id
+        }
+    }
+}
+"""
+
+SCENES_WITH_MARKERS_QUERY = (
+    """
+query FindScenesWithMarkers($filter: FindFilterType, $scene_filter: SceneFilterType, $get_count: Boolean!) {
+    findScenes(filter: $filter, scene_filter: $scene_filter) {
+        count @include(if: $get_count)
+        scenes {
+            ...SceneWithMarkers
+        }
+    }
+}
+"""
+    + SCENE_WITH_MARKERS_FRAGMENT
+)
+
+SCENE_WITH_MARKERS_QUERY = (
+    """
+query FindSceneWithMarkers($id: ID!) {
+    findScene(id: $id) {
+        ...SceneWithMarkers
+    }
+}
+"""
+    + SCENE_WITH_MARKERS_FRAGMENT
+)
+
+# Times a failed page request is retried, waiting PAGE_RETRY_DELAY seconds doubled on each attempt
+PAGE_RETRIES = 3
+PAGE_RETRY_DELAY = 2
+# After a page request slower than this many seconds, the next request waits until SLOW_PAGE_DELAY seconds
+# have passed since it, to let the server catch up
+SLOW_PAGE_SECONDS = 2
+SLOW_PAGE_DELAY = 5
+
+# stashapi raises HTTP failures as a plain Exception whose message starts with the status code
+_SERVER_ERROR_RE = re.compile(r"5\d\d\b")
 
 
 def convert_all_markers(stash: StashInterface, batch: int = 10):
@@ -18,103 +88,328 @@ def convert_all_markers(stash: StashInterface, batch: int = 10):
     """
     total = 1
     counter = 0
-    timeout = 5
     results = []
-    while True:
-        counter += 1
-        _current, scenes = stash.find_scenes(f={"has_markers": "true"}, filter={"per_page": batch, "page": counter}, get_count=True)
-
-        if counter == 1:
-            total = int(_current)
-            stash_log(f"found {total} scenes", lvl="info")
-
-        _current = batch * (counter - 1)
-        
-        if _current >= total:
-            break
-    
-        num_scenes = len(scenes)
-        # stash_log("scenes", scenes, lvl="trace")
-        stash_log(f"processing {num_scenes} / {_current} scenes", lvl="info")
-
-        for i in range(num_scenes):
-            scene = scenes[i]
-            _current -= 1
-            progress = (float(total) - float(_current)) / float(total)
-            stash_log(progress, lvl="progress")
-            stash_log(
-                f"{round(progress * 100, 2)}%: ",
-                f"evaluating scene index: {((counter - 1) * batch) + i} (id: {scene['id']})",
-                lvl="info",
-            )
+    converted = []
+    existing = list_output_dir(OUTPUT_DIR)
+    elapsed = 0
+    fetched = 0
+    try:
+        while batch * counter < total:
+            counter += 1
+            if elapsed > SLOW_PAGE_SECONDS:
+                # the time spent processing the last page counts towards the pause
+                pause = SLOW_PAGE_DELAY - (time.monotonic() - fetched)
+                if pause > 0:
+                    stash_log(f"page {counter - 1} took {round(elapsed, 2)}s, pausing for {round(pause, 2)}s", lvl="debug")
+                    time.sleep(pause)
+
+            # the total only needs to be counted once, so later pages skip the count query
+            count, scenes, elapsed = fetch_scenes_page(stash, counter, batch, get_count=counter == 1)
+            fetched = time.monotonic()
+
+            if counter == 1:
+                total = int(count)
+                stash_log(f"found {total} scenes", lvl="info")
+                if total == 0:
+                    break
+
+            offset = batch * (counter - 1)
+
+            # the markers are embedded in the page, so scenes without any can be skipped without another request
+            scenes = [scene for scene in scenes if scene["scene_markers"]]
+            num_scenes = len(scenes)
+            # stash_log("scenes", scenes, lvl="trace")
+            stash_log(f"processing {num_scenes} scenes from {offset + 1} / {total}", lvl="info")
+
+            # resolve (and download, if needed) the next scenes while the clips of the current one are extracted
+            resolved = queue.Queue(maxsize=2)
+            resolver = threading.Thread(target=resolve_scene_videos, args=(scenes, resolved), daemon=True)
+            resolver.start()
+
+            for i in range(num_scenes):
+                scene, scene_data = resolved.get()
+                progress = min(float(offset + i + 1) / float(total), 1)
+                stash_log(progress, lvl="progress")
+                stash_log(
+                    f"{round(progress * 100, 2)}%: ",
+                    f"evaluating scene index: {offset + i} (id: {scene['id']})",
+                    lvl="info",
+                )
+
+                markers = scene["scene_markers"]
+                stash_log("markers", markers, lvl="trace")
+                stash_log(f"found {len(markers)} markers", lvl="info")
+                result = None
+                if scene_data is None:
+                    # the reason was logged by the resolver thread, possibly before the previous scene finished
+                    stash_log(f"scene {scene['id']}: video could not be resolved, skipping...", lvl="info")
+                else:
+                    result = extract_scene_markers(stash, scene_data, markers, DEFAULT_DURATION, existing)
+                    if clips_exist(markers, DEFAULT_DURATION, existing):
+                        converted.append(scene["id"])
+                # the video isn't needed anymore, so a downloaded copy doesn't have to stay in the temp directory
+                release_stash_video(scene["id"])
+                results.append(result)
+
+            resolver.join()
+
+            stash_log("--end of loop--", lvl="debug")
+    finally:
+        # tagging only after the last page, so the pages of the excluding query don't shift while they are read,
+        # and also when a page fails, so the scenes finished before it are still recorded
+        tag_converted_scenes(stash, converted)
+
+
+def tag_converted_scenes(stash: StashInterface, scene_ids: list):
+    """
+    The tag_converted_scenes function adds the converted tag to the given scenes, so later runs skip them.
+    It does nothing if no converted_tag_id is configured.
+
+    :param stash: StashInterface: Pass the stash object to the function
+    :param scene_ids: list: Specify the ids of the scenes whose clips have all been extracted
+    :return: Nothing
+    :doc-author: Trelent
+    """
+    if not CONVERTED_TAG_ID or len(scene_ids) == 0:
+        return
+    try:
+        stash.update_scenes({"ids": scene_ids, "tag_ids": {"mode": "ADD", "ids": [str(CONVERTED_TAG_ID)]}})
+        stash_log(f"tagged {len(scene_ids)} converted scenes", lvl="info")
+    except Exception as ex:
+        stash_log(f"could not tag converted scenes: {ex}", lvl="error")
+        stash_log(traceback.format_exc(), lvl="error")
+
+
+def fetch_scenes_page(stash: StashInterface, page: int, per_page: int, get_count: bool = False):
+    """
+    The fetch_scenes_page function fetches a page of scenes with find_scenes_with_markers.
+    Requests that fail with a transient error are retried up to PAGE_RETRIES times, with an exponential backoff
+    between attempts. Any other error, like an invalid query, is raised right away.
+
+    :param stash: StashInterface: Pass the stash object to the function
+    :param page: int: Specify the page of scenes to fetch
+    :param per_page: int: Specify the number of scenes per page
+    :param get_count: bool: Request the total scene count along with the page
+    :return: A tuple of the total scene count, the list of scenes and the duration of the request in seconds
+    :doc-author: Trelent
+    """
+    for attempt in range(PAGE_RETRIES + 1):
+        started = time.monotonic()
+        try:
+            count, scenes = find_scenes_with_markers(stash, page, per_page, get_count)
+            return count, scenes, time.monotonic() - started
+        except Exception as ex:
+            if attempt == PAGE_RETRIES or not is_transient_error(ex):
+                raise
+            delay = PAGE_RETRY_DELAY * 2**attempt
+            stash_log(f"failed to fetch page {page}: {ex}, retrying in {delay}s", lvl="warn")
+            time.sleep(delay)
 
-            result = convert_single_scene(stash, scene["id"], DEFAULT_DURATION)
-            results.append(result)
 
-        stash_log("--end of loop--", lvl="debug")
-        time.sleep(timeout)
+def is_transient_error(ex: Exception) -> bool:
+    """
+    The is_transient_error function tells whether a failed request is worth retrying:
+    connection and timeout errors, and responses with a 5xx server error status.
+
+    :param ex: Exception: Pass in the error raised by the request
+    :return: True if the request may succeed when retried
+    :doc-author: Trelent
+    """
+    if isinstance(ex, requests.exceptions.HTTPError) and ex.response is not None:
+        return ex.response.status_code >= 500
+    if isinstance(ex, requests.exceptions.RequestException):
+        return True
+    return _SERVER_ERROR_RE.match(str(ex)) is not None
+
+
+def find_scenes_with_markers(stash: StashInterface, page: int, per_page: int, get_count: bool = False):
+    """
+    The find_scenes_with_markers function fetches a page of scenes that have markers,
+    leaving out the scenes already tagged as converted.
+    The file, path and marker data for each scene is embedded in the same response,
+    so no further requests are needed to convert the scene.
+
+    :param stash: StashInterface: Pass the stash object to the function
+    :param page: int: Specify the page of scenes to fetch
+    :param per_page: int: Specify the number of scenes per page
+    :param get_count: bool: Request the total scene count, which costs the server a separate count query
+    :return: A tuple of the total scene count (None unless get_count is set) and the list of scenes
+    :doc-author: Trelent
+    """
+    scene_filter = {"has_markers": "true"}
+    if CONVERTED_TAG_ID:
+        scene_filter["tags"] = {"value": [str(CONVERTED_TAG_ID)], "modifier": "EXCLUDES"}
+    variables = {
+        "filter": {"per_page": per_page, "page": page},
+        "scene_filter": scene_filter,
+        "get_count": get_count,
+    }
+    result = stash.call_GQL(SCENES_WITH_MARKERS_QUERY, variables)
+    return result["findScenes"].get("count"), result["findScenes"]["scenes"]
 
 
 def convert_single_scene(stash: StashInterface, scene_id: int, duration: int):
     """
     The convert_single_marker function takes a stash object, scene_id and duration as arguments.
-    It then calls the get_scene_markers function on the stash object to retrieve all markers for that scene.
-    If there are no markers it returns 0, otherwise it loops through each marker in the list of markers returned by get_scene_markers.
-    For each marker it calls convert marker with that specific marker and duration as arguments.
+    It then fetches the scene together with its markers in a single request.
+    If there are no markers it returns None, otherwise it passes the scene and its markers to convert_scene_markers.
 
     :param stash: StashInterface: Pass the stash object to the function
     :param scene_id: int: Identify the scene to be converted
     :param duration: int: Determine the length of the clip
-    :return: A list of results
+    :return: The result of the last converted marker
+    :doc-author: Trelent
+    """
+    scene = get_scene(stash, scene_id)
+    markers = scene["scene_markers"] if scene else None
+    if not markers:
+        stash_log("found 0 markers", lvl="info")
+        return None
+    existing = list_output_dir(OUTPUT_DIR)
+    result = convert_scene_markers(stash, scene, markers, duration, existing)
+    release_stash_video(scene["id"])
+    # the tag makes convertAll skip the scene, so only clips of the default duration count as converted
+    if duration == DEFAULT_DURATION and clips_exist(markers, duration, existing):
+        tag_converted_scenes(stash, [str(scene_id)])
+    return result
+
+
+def convert_scene_markers(stash: StashInterface, scene: dict, markers: list, duration: int, existing: set = None):
+    """
+    The convert_scene_markers function converts each of the given markers of a scene into a clip.
+    The scene and its markers are passed in directly, so no requests are made to the stash.
+
+    :param stash: StashInterface: Pass the stash object to the function
+    :param scene: dict: Pass in the scene data, including files and paths
+    :param markers: list: Pass in the markers of the scene
+    :param duration: int: Determine the length of the clip
+    :param existing: set: Pass in the file names already in the output directory, listed on demand if omitted
+    :return: The result of the last converted marker
     :doc-author: Trelent
     """
-    total = 1
-    counter = 0
-    timeout = 5
-    results = []
-    markers = stash.get_scene_markers(scene_id)
     total = len(markers) if markers else 0
     stash_log("markers", markers, lvl="trace")
     stash_log(f"found {total} markers", lvl="info")
-    if total > 0:
-        scene = get_scene(stash, scene_id)
-        for i in range(total):
+    if total == 0:
+        return None
+
+    scene_data = resolve_scene_video(scene)
+    if scene_data is None:
+        return None
+    return extract_scene_markers(stash, scene_data, markers, duration, existing)
+
+
+def resolve_scene_video(scene: dict):
+    """
+    The resolve_scene_video function locates (or downloads) the video file of a scene with get_stash_video.
+    Errors are logged rather than raised, so it can run on the resolver thread of convert_all_markers.
+
+    :param scene: dict: Pass in the scene data, including files and paths
+    :return: The video data of the scene, or None if it can't be converted
+    :doc-author: Trelent
+    """
+    try:
+        scene_data = get_stash_video(scene) if scene else None
+    except Exception as ex:
+        stash_log(f"scene {scene['id']}: {ex}", lvl="error")
+        stash_log(traceback.format_exc(), lvl="error")
+        return None
+    if scene_data is None:
+        stash_log(f"scene {scene['id']}: invalid video extension.", lvl="info")
+    return scene_data
+
+
+def resolve_scene_videos(scenes: list, resolved: queue.Queue):
+    """
+    The resolve_scene_videos function resolves the video file of each scene in turn, and puts the
+    (scene, scene_data) pairs on the resolved queue. It blocks while the queue is full.
+
+    :param scenes: list: Pass in the scenes to resolve
+    :param resolved: queue.Queue: Pass in the queue the resolved scenes are put on
+    :return: Nothing
+    :doc-author: Trelent
+    """
+    for scene in scenes:
+        resolved.put((scene, resolve_scene_video(scene)))
+
+
+def extract_scene_markers(stash: StashInterface, scene_data: dict, markers: list, duration: int, existing: set = None):
+    """
+    The extract_scene_markers function extracts the clips for the markers of a scene whose video is already resolved.
+    All clips are extracted by a single ffmpeg process, unless its command line would be too long.
+
+    :param stash: StashInterface: Pass the stash object to the function
+    :param scene_data: dict: Pass in the resolved video data of the scene, as returned by get_stash_video
+    :param markers: list: Pass in the markers of the scene
+    :param duration: int: Determine the length of the clip
+    :param existing: set: Pass in the file names already in the output directory, listed on demand if omitted
+    :return: The result of the last converted marker
+    :doc-author: Trelent
+    """
+    if existing is None:
+        existing = list_output_dir(OUTPUT_DIR)
+
+    try:
+        results = extract_clips(scene_data["path"], markers, duration, OUTPUT_DIR, existing)
+    except Exception as ex:
+        stash_log(f"{scene_data['path']}: {ex}", lvl="error")
+        stash_log(traceback.format_exc(), lvl="error")
+        return None
+    if results is None:
+        stash_log("ffmpeg command line too long, extracting clips one at a time", lvl="debug")
+        results = convert_markers(stash, markers, scene_data, duration, existing)
+    return results[-1]
+
+
+def convert_markers(stash: StashInterface, markers: list, scene_data: dict, duration: int, existing: set):
+    """
+    The convert_markers function converts each marker of a scene into a clip, running one ffmpeg process per marker.
+    The extractions are run concurrently, and progress is logged as each of them completes.
+
+    :param stash: StashInterface: Pass the stash object to the function
+    :param markers: list: Pass in the markers of the scene
+    :param scene_data: dict: Pass in the resolved video data of the scene, as returned by get_stash_video
+    :param duration: int: Determine the length of the clip
+    :param existing: set: Pass in the file names already in the output directory
+    :return: A list of results, in the order of the markers
+    :doc-author: Trelent
+    """
+    total = len(markers)
+    counter = 0
+    # ffmpeg runs out-of-process, so threads are enough to run the extractions concurrently
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = {executor.submit(convert_marker, stash, marker, scene_data, duration, existing): marker for marker in markers}
+        for future in as_completed(futures):
             counter += 1
-            marker = markers[i]
+            marker = futures[future]
             progress = float(counter) / float(total)
             stash_log(progress, lvl="progress")
             stash_log(
                 f"{round(progress * 100, 2)}%: ",
-                f"evaluating marker index: {counter} (id: {marker['id']})",
+                f"converted marker index: {counter} (id: {marker['id']})",
                 lvl="info",
             )
-            result = convert_marker(stash, marker, scene, duration)
-            results.append(result)
-    return result
+    return [future.result() for future in futures]
 
 
-def convert_marker(stash: StashInterface, marker: dict, scene: dict, duration: int):
+def convert_marker(stash: StashInterface, marker: dict, scene_data: dict, duration: int, existing: set):
     """
     The convert_marker function takes a marker and converts it into a clip.
 
     :param stash: StashInterface: Access the stash
     :param marker: dict: Get the marker data from the database
+    :param scene_data: dict: Pass in the resolved video data of the scene, as returned by get_stash_video
     :param duration: int: Specify the length of the clip to be extracted
+    :param existing: set: Pass in the file names already in the output directory
     :return: A path to a video file
     :doc-author: Trelent
     """
     try:
         scene_path = None
         stash_log("Converting marker: ", marker, lvl="trace")
-        if marker:
-            if scene:
-                scene_data = get_stash_video(scene)
-                if scene_data is None:
-                    stash_log("invalid video extension.", lvl="info")
-                    return
-
-                scene_path = scene_data["path"]
-                return extract_clip(scene_path, marker, duration, OUTPUT_DIR)
+        if marker and scene_data:
+            scene_path = scene_data["path"]
+            return extract_clip(scene_path, marker, duration, OUTPUT_DIR, existing)
     except Exception as ex:
         stash_log(f"{scene_path}: {ex}", lvl="error")
         stash_log(traceback.format_exc(), lvl="error")
@@ -124,12 +419,12 @@ def convert_marker(stash: StashInterface, marker: dict, scene: dict, duration: i
 def get_scene(stash: StashInterface, scene_id: int) -> dict:
     """
     The get_scene function takes a stash object and a scene_id as input.
-    It then uses the find_scene function from the StashInterface class to return
-    a dictionary containing all of the information about that scene.
+    It then queries the scene with its files, paths and markers, and returns
+    a dictionary containing that information.
 
     :param stash: StashInterface: Tell the function that stash is an object of type stashinterface
     :param scene_id: int: Specify the scene id to find
     :return: A dictionary with the following keys:
     :doc-author: Trelent
     """
-    return stash.find_scene(scene_id)
+    return stash.call_GQL(SCENE_WITH_MARKERS_QUERY, {"id": str(scene_id)})["findScene"]
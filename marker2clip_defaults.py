@@ -9,4 +9,5 @@ default_settings = {
     "output_dir": "",
     "default_duration": 60,
     "converted_tag_id": "",
+    "log_level": "trace",
 }